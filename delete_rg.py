@@ -1,66 +1,164 @@
 import os
-import re
-import smtplib
-from email.mime.text import MIMEText
-from email.header import Header
-
-def send_mail(flag,key):
-    """Send an email to remind successfully deleted and undeleted resource group"""
-    from_addr = 'xiuxi.sun@qq.com'
-    password = 'djwgzuhzrqwubbcb'
-    to_addr = ['v-xisu@microsoft.com', ]
-    smtp_server = 'smtp.qq.com'
-    if flag:
-        content = "Success delete: " + key
-    else:
-        content = "Unsuccess delete: " + key
-
-    msg = MIMEText(content,'plain','utf-8')
-    msg['From'] = Header(from_addr)
-    msg['Subject'] = Header("Delete Unuse Resource Group")
-    server = smtplib.SMTP_SSL()
-    server.connect(smtp_server,465)
-    server.login(from_addr, password)
-    for mail_box in to_addr:
-        msg['To'] = Header(mail_box)
-        server.sendmail(from_addr, mail_box, msg.as_string())
-    server.quit()
+import time
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from msrestazure.azure_exceptions import CloudError
+from azure.common.credentials import ServicePrincipalCredentials, get_azure_cli_credentials
+from azure.mgmt.resource import ResourceManagementClient, ManagementLockClient
+from notifier import MailNotifier
 
+SUBSCRIPTION_ID = 'f64d4ee8-be94-457d-ba26-3fa6b6506cef'
+# Only resource groups whose name starts with this prefix are deleted
+RG_PREFIX = 'sampletest'
+# Optional (tag name, tag value) pair, filtered on the server side, e.g. ('purpose', 'test')
+RG_TAG = None
+# Skip resource groups holding resources created within the last MIN_AGE_HOURS hours, 0 disables the check.
+# Empty resource groups have no creation time and are always deleted, whatever their age.
+MIN_AGE_HOURS = 0
+# Skip resource groups with a management lock
+SKIP_LOCKED = True
+# Number of delete requests, or age checks, issued at the same time
+MAX_PARALLEL = 8
+# Attempts per delete when ARM throttles the request
+MAX_RETRIES = 5
+# Seconds between two checks of the remaining resource groups
+POLL_INTERVAL = 30
+# Give up waiting for deletions after this many seconds
+WAIT_TIMEOUT = 3 * 60 * 60
 
-def Get_RG():
-    """ Get resource group list func """
+_clients = None
+
+
+def get_clients():
+    """ Build the resource and lock management clients once, from the service principal env or the az login """
+
+    global _clients
+    if _clients is None:
+        if os.environ.get('AZURE_CLIENT_ID'):
+            credentials = ServicePrincipalCredentials(client_id=os.environ['AZURE_CLIENT_ID'],
+                                                      secret=os.environ['AZURE_SECRET'],
+                                                      tenant=os.environ['AZURE_TENANT'])
+        else:
+            credentials = get_azure_cli_credentials()[0]
+        _clients = (ResourceManagementClient(credentials, SUBSCRIPTION_ID),
+                    ManagementLockClient(credentials, SUBSCRIPTION_ID))
+    return _clients
+
+def List_RG():
+    """ Lazily page through the resource groups matching the prefix and tag filter """
+
+    rg_filter = None
+    if RG_TAG:
+        rg_filter = "tagName eq '%s' and tagValue eq '%s'" % RG_TAG
+    for group in get_clients()[0].resource_groups.list(filter=rg_filter):
+        if group.name.startswith(RG_PREFIX):
+            yield group
+
+def is_old_enough(key):
+    """ A group is old enough when none of its resources was created within the last MIN_AGE_HOURS hours
+
+    ARM gives no creation time for the group itself, so an empty group always is.
+    """
+
+    created_before = datetime.datetime.utcnow() - datetime.timedelta(hours=MIN_AGE_HOURS)
+    for resource in get_clients()[0].resources.list_by_resource_group(key, expand='createdTime'):
+        if resource.created_time and resource.created_time.replace(tzinfo=None) > created_before:
+            return False
+    return True
 
-    list_id = []
-    get_item = '/usr/local/bin/az group list --subscription f64d4ee8-be94-457d-ba26-3fa6b6506cef --output json'
-    ret = os.popen(get_item).readlines()
-    reg = '"id": "/subscriptions/f64d4ee8-be94-457d-ba26-3fa6b6506cef/'
-    for resource in ret:
-        if reg in resource:
-            item = re.split(r'"|/',resource)[7]
-            if item.startswith('sampletest'):
-                list_id.append(item)
+def get_locked_groups():
+    """ Lower case names of the resource groups holding a lock on themselves or on one of their resources
 
-    return list_id
+    Return None when a lock is set on the whole subscription.
+    """
+
+    locked = set()
+    for lock in get_clients()[1].management_locks.list_at_subscription_level():
+        parts = lock.id.split('/')
+        if len(parts) < 5 or parts[3].lower() != 'resourcegroups':
+            return None
+        locked.add(parts[4].lower())
+    return locked
+
+def Get_RG():
+    """ Get resource group list func, applying the prefix, tag, state, age and lock policies """
+
+    locked = get_locked_groups() if SKIP_LOCKED else set()
+    if locked is None:
+        print("The subscription is locked, no resource group will be delete")
+        return
+    candidates = []
+    for group in List_RG():
+        if group.properties and group.properties.provisioning_state == 'Deleting':
+            continue
+        if group.name.lower() in locked:
+            continue
+        candidates.append(group.name)
+    if not MIN_AGE_HOURS:
+        for key in candidates:
+            yield key
+        return
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL) as executor:
+        for key, old_enough in zip(candidates, executor.map(is_old_enough, candidates)):
+            if old_enough:
+                yield key
 
 def Delete_RG(key):
-     """ Delete resource group func """
-
-     success_flag = True
-     del_item = '/usr/local/bin/az group delete -y --name '
-     print("The resource group :%s will be delete:"%key)
-     try:
-         os.system(del_item + key)
-     except Exception:
-         success_flag = False
-         print(" Delete resource group %s error"%key)
-     finally:
-         send_mail(success_flag,key)
+    """ Start the deletion of a resource group without polling it, retry when throttled """
+
+    print("The resource group :%s will be delete:"%key)
+    for attempt in range(MAX_RETRIES):
+        try:
+            # No LROPoller thread per group, Wait_RG is the only one tracking the deletions
+            get_clients()[0].resource_groups.delete(key, polling=False)
+            return True
+        except CloudError as exc:
+            if exc.status_code != 429 or attempt == MAX_RETRIES - 1:
+                print(" Delete resource group %s error: %s"%(key, exc))
+                return False
+        except Exception as exc:
+            # Request, authentication or connection errors, the group is reported as undeleted
+            print(" Delete resource group %s error: %s"%(key, exc))
+            return False
+        time.sleep(2 ** attempt)
+
+def Wait_RG(keys):
+    """ Poll the resource group list until the given groups are gone, return the groups not deleted
+
+    A group still listed but no longer in the Deleting state had its deletion fail, it is reported at once.
+    """
+
+    pending = set(keys)
+    failed = set()
+    deadline = time.time() + WAIT_TIMEOUT
+    while pending and time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+        try:
+            states = dict((group.name, group.properties.provisioning_state if group.properties else None)
+                          for group in List_RG())
+        except Exception as exc:
+            # A transient listing error must not lose the report, try again on the next round
+            print("List resource group error: %s"%exc)
+            continue
+        failed |= set(key for key in pending if key in states and states[key] != 'Deleting')
+        pending = set(key for key in pending if states.get(key) == 'Deleting')
+        print("%d resource group(s) still deleting"%len(pending))
+    return pending | failed
 
 def main():
 
-     list_id = Get_RG()
-     for key in list_id:
-         Delete_RG(key)
+     # Read the mail settings before deleting anything, a missing one must not lose the report of a long run
+     with MailNotifier("Delete Unuse Resource Group") as notifier:
+         list_id = list(Get_RG())
+         with ThreadPoolExecutor(max_workers=MAX_PARALLEL) as executor:
+             started = dict(zip(list_id, executor.map(Delete_RG, list_id)))
+         undeleted = set(key for key, ok in started.items() if not ok)
+         undeleted |= Wait_RG([key for key, ok in started.items() if ok])
+         for key in sorted(list_id):
+             if key in undeleted:
+                 notifier.notify("Unsuccess delete: " + key)
+             else:
+                 notifier.notify("Success delete: " + key)
 
 if __name__ == "__main__":
     main()
@@ -6,44 +6,153 @@
 # usage: put this script in the azure collection directory which contains tests and plugins
 #        python module_without_test.py
 #        or python module_without_test.py -d
+#        or python module_without_test.py --json [-d]
+#        add --no-cache to rescan all the tasks files instead of only the changed ones
+#        add --cache-file=<path> to choose the cache file, by default it is kept out of the collection directory in
+#        $XDG_CACHE_HOME/module_without_test/ (~/.cache when unset), one file per collection path
 
 import os
 import re
+import json
+import hashlib
 import logging
 import sys
 import getopt
-import traceback
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+MODULE_PATTERN = re.compile("azure_rm_[a-z_]+")
+MAX_WORKERS = 16
+# Bump when the layout of the cache file changes
+CACHE_VERSION = 1
 
 warn_msg = []
 modules = {}
 
 
-def get_tests():
+def scan_file(test_file_name):
+    """ Count the azure_rm_* references of one tasks file, reading it line by line """
+    test_modules = Counter()
+    try:
+        with open(test_file_name) as test_file:
+            for line in test_file:
+                test_modules.update(MODULE_PATTERN.findall(line))
+    except (IOError, UnicodeDecodeError) as er:
+        logging.error("can not read {0}: {1}".format(test_file_name, er))
+        return None
+    return test_modules
+
+
+def list_task_files(test_dir_path):
+    for target in sorted(os.listdir(test_dir_path)):
+        if not MODULE_PATTERN.match(target):
+            continue
+        tasks_dir = os.path.join(test_dir_path, target, 'tasks')
+        if not os.path.isdir(tasks_dir):
+            continue
+        for task in sorted(os.listdir(tasks_dir)):
+            yield target, task, os.path.join(tasks_dir, task)
+
+
+def is_cache_entry(entry):
+    return isinstance(entry, dict) and \
+        isinstance(entry.get('mtime'), int) and \
+        isinstance(entry.get('size'), int) and \
+        isinstance(entry.get('modules'), dict) and \
+        all(isinstance(count, int) for count in entry['modules'].values())
+
+
+def default_cache_file():
+    """ One cache file per collection checkout, under the user cache directory """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    checkout_key = hashlib.sha1(os.getcwd().encode('utf-8')).hexdigest()
+    return os.path.join(cache_home, 'module_without_test', checkout_key + '.json')
+
+
+def load_cache(cache_file):
+    """ Return the cached files, or an empty cache when the file is missing, corrupted or from another version """
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get('version') != CACHE_VERSION or \
+            cache.get('pattern') != MODULE_PATTERN.pattern or not isinstance(cache.get('files'), dict):
+        return {}
+    if not all(is_cache_entry(entry) for entry in cache['files'].values()):
+        return {}
+    return cache['files']
+
+
+def save_cache(cache_file, cache):
+    cache_dir = os.path.dirname(cache_file)
+    if cache_dir and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_file = cache_file + ".tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'pattern': MODULE_PATTERN.pattern, 'files': cache}, f, sort_keys=True)
+    os.replace(tmp_file, cache_file)
+
+
+def scan_files(test_dir_path, task_files, cache):
+    """ Return the references of every tasks file, rescanning only the files whose mtime or size changed
+
+    The cache maps the file path relative to the targets directory to its mtime, size and references,
+    it is updated in place and only keeps the files still present.
+    """
+    stat_keys = {}
+    stale = []
+    for target, task, test_file_name in task_files:
+        key = os.path.relpath(test_file_name, test_dir_path)
+        try:
+            stat = os.stat(test_file_name)
+        except OSError as er:
+            # A dangling symlink or a file removed meanwhile, reported as unreadable by get_tests
+            logging.error("can not read {0}: {1}".format(test_file_name, er))
+            continue
+        stat_keys[key] = [stat.st_mtime_ns, stat.st_size]
+        entry = cache.get(key)
+        if entry is None or [entry['mtime'], entry['size']] != stat_keys[key]:
+            stale.append((key, test_file_name))
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for (key, test_file_name), test_modules in zip(stale, executor.map(scan_file, [name for key, name in stale])):
+            if test_modules is None:
+                cache.pop(key, None)
+                continue
+            cache[key] = {
+                'mtime': stat_keys[key][0],
+                'size': stat_keys[key][1],
+                'modules': dict(test_modules)
+            }
+    for key in list(cache.keys()):
+        if key not in stat_keys:
+            del cache[key]
+    results = []
+    for target, task, test_file_name in task_files:
+        entry = cache.get(os.path.relpath(test_file_name, test_dir_path))
+        results.append(Counter(entry['modules']) if entry is not None else None)
+    return results
+
+
+def get_tests(cache_file=None):
     global modules
     global warn_msg
     test_dir_path = os.path.join(os.getcwd(), "tests", 'integration', 'targets')
-    targets = os.listdir(test_dir_path)
-    pattern = "azure_rm_[a-z_]+"
-    for target in targets:
-        if not re.match(pattern, target):
+    task_files = list(list_task_files(test_dir_path))
+    cache = load_cache(cache_file) if cache_file else {}
+    results = scan_files(test_dir_path, task_files, cache)
+    if cache_file:
+        save_cache(cache_file, cache)
+    for (target, task, test_file_name), test_modules in zip(task_files, results):
+        if test_modules is None:
+            warn_msg.append("unreadable file, target name: {0}, task name: {1}".format(target, task))
             continue
-        tasks = os.listdir(os.path.join(test_dir_path, target, 'tasks'))
-        for task in tasks:
-            test_file_name = os.path.join(test_dir_path, target, 'tasks', task)
-            try:
-                test_file = open(test_file_name)
-                file_content = test_file.read()
-                test_modules = re.findall(pattern, file_content)
-                for test_module in test_modules:
-                    if modules.get(test_module) is None:
-                        warn_msg.append("{0} is not implemented but find in the test, target name: {1}, task name: {2}".format(test_module, target, task))
-                        continue
-                    modules[test_module]['test_count'] = modules[test_module]['test_count'] +1
-                    modules[test_module]['test_files'].add(target)
-            except Exception as er:
-                traceback.print_exc()
-                logging.error("target name: {0}  task name: {1}".format(target, task))
-                exit(1)
+        for test_module, count in test_modules.items():
+            if modules.get(test_module) is None:
+                warn_msg.append("{0} is not implemented but find in the test, target name: {1}, task name: {2}".format(test_module, target, task))
+                continue
+            modules[test_module]['test_count'] += count
+            modules[test_module]['test_files'].add(target)
 
 
 def get_modules():
@@ -63,6 +172,20 @@ def get_modules():
         modules[module_name] = module_info
 
 
+def output_json(detail):
+    global modules
+    global warn_msg
+
+    result = {
+        'modules_without_test': [name for name in sorted(modules.keys()) if modules[name]['test_count'] == 0],
+        'warnings': warn_msg
+    }
+    if detail:
+        result['details'] = dict((name, {'test_count': info['test_count'], 'test_files': sorted(info['test_files'])})
+                                 for name, info in modules.items())
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+
 def output_result(detail):
     global modules
     global warn_msg
@@ -84,20 +207,34 @@ def output_result(detail):
 
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, "d")
+        opts, args = getopt.getopt(argv, "d", ["json", "no-cache", "cache-file="])
     except getopt.GetoptError:
         msg = "usage: python module_without_test.py \n " \
               " options: \n" \
-              "     -d : to get the details"
+              "     -d : to get the details \n" \
+              "     --json : print the result as json \n" \
+              "     --no-cache : rescan every tasks file without reading or writing the cache \n" \
+              "     --cache-file=<path> : cache file, default {0}".format(default_cache_file())
         print(msg)
         sys.exit(2)
     detail = False
+    as_json = False
+    cache_file = default_cache_file()
     for opt, arg in opts:
         if opt == '-d':
             detail = True
+        elif opt == '--json':
+            as_json = True
+        elif opt == '--no-cache':
+            cache_file = None
+        elif opt == '--cache-file':
+            cache_file = arg
     get_modules()
-    get_tests()
-    output_result(detail)
+    get_tests(cache_file)
+    if as_json:
+        output_json(detail)
+    else:
+        output_result(detail)
 
 
 if __name__ == '__main__':
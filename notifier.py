@@ -0,0 +1,111 @@
+import os
+import time
+import smtplib
+import threading
+from email.mime.text import MIMEText
+from email.header import Header
+
+
+class MailNotifier(object):
+    """ Send notifications over one persistent SMTP_SSL connection, batching them into digest emails
+
+    Credentials come from the environment:
+        SMTP_USER      sender address used to log in
+        SMTP_PASSWORD  password or authorization code of the sender
+        SMTP_SERVER    SMTP server, default smtp.qq.com
+        SMTP_PORT      SSL port, default 465
+        MAIL_TO        comma separated list of receivers
+    """
+
+    def __init__(self, subject, window=60, retries=3):
+        self.subject = subject
+        self.from_addr = os.environ['SMTP_USER']
+        self.password = os.environ['SMTP_PASSWORD']
+        self.to_addr = [addr.strip() for addr in os.environ['MAIL_TO'].split(',') if addr.strip()]
+        self.smtp_server = os.environ.get('SMTP_SERVER', 'smtp.qq.com')
+        self.port = int(os.environ.get('SMTP_PORT', 465))
+        # Messages queued within this many seconds are sent as one digest
+        self.window = window
+        self.retries = retries
+        self.server = None
+        self.queue = []
+        self.first_queued = None
+        # Receivers refused by the server, with the error, they are skipped and not retried
+        self.refused = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def connect(self):
+        """ Open and log in the connection, if it is not already open """
+        if self.server is None:
+            self.server = smtplib.SMTP_SSL(self.smtp_server, self.port)
+            self.server.login(self.from_addr, self.password)
+        return self.server
+
+    def disconnect(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.server = None
+
+    def notify(self, content):
+        """ Queue one message, the digest is sent once the batching window is over """
+        with self.lock:
+            if not self.queue:
+                self.first_queued = time.time()
+            self.queue.append(content)
+            if time.time() - self.first_queued >= self.window:
+                self._flush()
+
+    def flush(self):
+        """ Send the queued messages as one digest now """
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            try:
+                self._flush()
+            finally:
+                self.disconnect()
+
+    def _flush(self):
+        if not self.queue:
+            return
+        msg = MIMEText('\n'.join(self.queue), 'plain', 'utf-8')
+        msg['From'] = Header(self.from_addr)
+        msg['Subject'] = Header(self.subject)
+        delivered = set()
+        for attempt in range(self.retries):
+            try:
+                server = self.connect()
+                for mail_box in self.to_addr:
+                    if mail_box in delivered:
+                        continue
+                    del msg['To']
+                    msg['To'] = Header(mail_box)
+                    try:
+                        server.sendmail(self.from_addr, mail_box, msg.as_string())
+                    except smtplib.SMTPRecipientsRefused as exc:
+                        print("Receiver {0} refused: {1}".format(mail_box, exc.recipients))
+                        self.refused[mail_box] = exc.recipients
+                    delivered.add(mail_box)
+                break
+            except (smtplib.SMTPServerDisconnected, OSError) as exc:
+                # SMTPException derives from OSError, only a lost connection is worth a new login
+                if isinstance(exc, smtplib.SMTPException) and not isinstance(exc, smtplib.SMTPServerDisconnected):
+                    raise
+                # Close the broken connection, the next attempt logs in again and skips the handled receivers
+                self.disconnect()
+                if attempt == self.retries - 1:
+                    raise
+                time.sleep(2 ** attempt)
+        self.queue = []
+        self.first_queued = None